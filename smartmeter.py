@@ -19,15 +19,22 @@
 #  
 #  Copyright (c) 2020 Joerg Beckers
 
-import RPi.GPIO as GPIO
+import pigpio
 import logging
 import json
 import os
 import argparse
+import array
+import asyncio
+import threading
 import serial
+import serial_asyncio_fast
+import struct
+from multiprocessing import shared_memory
 import re
+import time
 from tzlocal import get_localzone
-from datetime import datetime, timedelta, time, timezone
+from datetime import datetime, timedelta, timezone
 from raspend import RaspendApplication, ThreadHandlerBase
 from collections import namedtuple
 
@@ -44,124 +51,293 @@ class SmartMeterKeys:
 class SmartMeterConstants:
     """ Some constants used for identifying begin and end of a datagram.
     """
-    DATAGRAM_INITIATOR = '/'
-    DATAGRAM_TERMINATOR = '!'
+    DATAGRAM_INITIATOR = b'/'
+    DATAGRAM_TERMINATOR = b'!'
+    DATAGRAM_MAX_SIZE = 1024
 
-class ReadSmartMeter(ThreadHandlerBase):
-    """ This class reads the datagrams of the EBZ DD3 from the USB device attached to the 'Info-DSS' of the smart meter.
+# The last second formatted by '_isoNowUTC' and its ISO 8601 representation.
+_TIMESTAMP_CACHE = [0, ""]
+
+def _isoNowUTC():
+    """ Returns the current UTC time as ISO 8601 string with a resolution of one second. 
+        The string is formatted only once per second and cached otherwise.
     """
-    def __init__(self, sectionName, serialPort, localTimeZone):
+    now = int(time.time())
+    if now != _TIMESTAMP_CACHE[0]:
+        _TIMESTAMP_CACHE[:] = [now, datetime.fromtimestamp(now, timezone.utc).isoformat()]
+    return _TIMESTAMP_CACHE[1]
+
+# The OBIS codes we are interested in and their names, in the order they are published in the shared dictionary.
+_OBIS_VALUES = (
+    (SmartMeterKeys.POWER_IMPORT, "POWER_IMPORT"),
+    (SmartMeterKeys.POWER_EXPORT, "POWER_EXPORT"),
+    (SmartMeterKeys.CURRENT_POWER_SUM, "CURRENT_POWER_SUM"),
+    (SmartMeterKeys.CURRENT_POWER_L1, "CURRENT_POWER_L1"),
+    (SmartMeterKeys.CURRENT_POWER_L2, "CURRENT_POWER_L2"),
+    (SmartMeterKeys.CURRENT_POWER_L3, "CURRENT_POWER_L3"),
+)
+
+# Maps the OBIS codes, as they appear in the raw datagram, to their position in the published lists.
+_OBIS_INDEX = {code.encode(): index for index, (code, name) in enumerate(_OBIS_VALUES)}
+
+# Matches the OBIS code, value and unit of the energy (x.8.0) and power (x.7.0) lines of a datagram.
+# The pattern is applied to the raw bytes, so the datagram doesn't need to be decoded as a whole.
+_OBIS_RE = re.compile(rb"1-0:(\d+\.[87]\.0)\*255\((-?\d+)\.(\d+)\*(\w+)\)")
+
+def _parseThousandths(intDigits, fracDigits):
+    """ Converts the digits of a decimal value like '-000811.78' into an integer count of thousandths, rounded half away from zero.
+        This avoids parsing a float and rounding it afterwards.
+    """
+    thousandths = int(intDigits + fracDigits[:3].ljust(3, b"0"))
+    if fracDigits[3:4] >= b"5":
+        thousandths += -1 if intDigits.startswith(b"-") else 1
+    return thousandths
+
+class S0Constants:
+    """ Constants used for setting up the GPIO pin connected to the S0 interface.
+    """
+    # DIN 43864 specifies a pulse width of at least 30ms. Level changes shorter than this (in microseconds) are ignored.
+    GLITCH_FILTER = 10000
+    # Number of pulse timestamps the ISR can store before they have to be drained. Must be a power of two.
+    RING_SIZE = 1024
+
+class SharedMemoryMirror():
+    """ This class mirrors the values of both smart meters into a named block of shared memory.
+        Other processes on the RPi can read them from there without going through HTTP or the access lock.
+        The D0 values are stored first, ordered like '_OBIS_VALUES' and followed by their timestamp. The S0 counter and its 
+        timestamp follow. Values are doubles (NaN if not yet received), timestamps are nanoseconds since the epoch (UTC), 
+        all in little-endian byte order. Writes are not synchronized with readers, so a reader may rarely see a record 
+        that is only partly updated.
+    """
+    D0_RECORD = struct.Struct("<{}dQ".format(len(_OBIS_VALUES)))
+    S0_RECORD = struct.Struct("<dQ")
+
+    def __init__(self, name):
+        self._memory = shared_memory.SharedMemory(name=name, create=True, size=self.D0_RECORD.size + self.S0_RECORD.size)
+        self.writeD0([None] * len(_OBIS_VALUES), 0)
+        self.writeS0(float("nan"), 0)
+
+    def writeD0(self, values, timestamp):
+        """ Writes the values of the D0 interface and their timestamp.
+        """
+        self.D0_RECORD.pack_into(self._memory.buf, 0, *[float("nan") if value is None else value for value in values], timestamp)
+
+    def writeS0(self, count, timestamp):
+        """ Writes the counter value of the S0 interface and its timestamp.
+        """
+        self.S0_RECORD.pack_into(self._memory.buf, self.D0_RECORD.size, count, timestamp)
+
+    def close(self):
+        """ Releases and removes the block of shared memory.
+        """
+        self._memory.close()
+        self._memory.unlink()
+
+class D0Protocol(asyncio.Protocol):
+    """ This protocol receives the datagrams of the EBZ DD3 from the USB device attached to the 'Info-DSS' of the smart meter.
+        Received data is buffered until a datagram terminator arrives. Then the complete datagram is parsed immediately.
+        The values are published as parallel lists, ordered like '_OBIS_VALUES', which keeps the JSON flat and small.
+    """
+    def __init__(self, sectionName, sharedDict, accessLock, sharedMemory=None):
         self.sectionName = sectionName
-        self.serialPort = serialPort
-        self.localTimeZone = localTimeZone
-        self.datagramBuffer = list()
-        self.OBISCodeMap = dict()
-        self.OBISCodeMap[SmartMeterKeys.POWER_IMPORT] = "POWER_IMPORT"
-        self.OBISCodeMap[SmartMeterKeys.POWER_EXPORT] = "POWER_EXPORT"
-        self.OBISCodeMap[SmartMeterKeys.CURRENT_POWER_SUM] = "CURRENT_POWER_SUM"
-        self.OBISCodeMap[SmartMeterKeys.CURRENT_POWER_L1] = "CURRENT_POWER_L1"
-        self.OBISCodeMap[SmartMeterKeys.CURRENT_POWER_L2] = "CURRENT_POWER_L2"
-        self.OBISCodeMap[SmartMeterKeys.CURRENT_POWER_L3] = "CURRENT_POWER_L3"
-        return 
+        self.sharedDict = sharedDict
+        self.accessLock = accessLock
+        self.sharedMemory = sharedMemory
+        self._buffer = bytearray()
+        if sectionName not in self.sharedDict:
+            self.sharedDict[sectionName] = {"OBIS_Codes": [code for code, name in _OBIS_VALUES], 
+                                            "names": [name for code, name in _OBIS_VALUES], 
+                                            "values": [None] * len(_OBIS_VALUES), 
+                                            "units": [None] * len(_OBIS_VALUES), 
+                                            "timestampUTC": None}
 
     def extractSmartMeterValues(self, datagram):
         """ This method extracts only the relevant parts of the datagram and writes them into the shared dictionary.
+            The caller must hold the access lock.
         """ 
-        regex = r"1-0:(\d+.[8|7].0)\*255\((-?\d+.\d+)\*(\w+)\)"
-        matches = re.finditer(regex, datagram)
         thisDict = self.sharedDict[self.sectionName]
-        thisDict["timestampUTC"] = datetime.now(timezone.utc).isoformat()
-        for match in matches:
-            strOBISCode = match.group(1)
-            if strOBISCode in self.OBISCodeMap:
-                thisDict[self.OBISCodeMap[strOBISCode]] = {"OBIS_Code": strOBISCode, "value": round(float(match.group(2)), 3), "unit" : match.group(3)}
+        thisDict["timestampUTC"] = _isoNowUTC()
+        values = thisDict["values"]
+        units = thisDict["units"]
+        for rawOBISCode, rawIntDigits, rawFracDigits, rawUnit in _OBIS_RE.findall(datagram):
+            index = _OBIS_INDEX.get(rawOBISCode)
+            if index is not None:
+                values[index] = _parseThousandths(rawIntDigits, rawFracDigits) / 1000
+                # D0 datagrams are 7-bit ASCII.
+                units[index] = rawUnit.decode("ascii")
+        if self.sharedMemory is not None:
+            self.sharedMemory.writeD0(values, time.time_ns())
         return 
 
-    def prepare(self):
-        """ Open the connected USB device for reading.
+    def data_received(self, data):
+        """ Called by the serial transport whenever data has been received.
+            Framing is a simple state machine: while the buffer is empty, we are hunting for a datagram initiator and 
+            drop everything before it. Once a datagram has begun, data is collected up to its terminator and the complete 
+            datagram is parsed through a memoryview of the buffer, so it isn't copied. 
         """
-        if not self.sectionName in self.sharedDict:
-            self.sharedDict[self.sectionName] = dict()
-
-        self.serial = serial.Serial(self.serialPort,
-                                    baudrate = 9600,
-                                    parity=serial.PARITY_EVEN,
-                                    stopbits=serial.STOPBITS_ONE,
-                                    bytesize=serial.SEVENBITS,
-                                    timeout=1)
-        return 
+        buffer = self._buffer
+        view = memoryview(data)
+        pos = 0
 
-    def invoke(self):
-        """ Reads one datagram per invocation. 
-            Since the smart meter pushes one datagram every second, this should be the minimal timeout for this method.
-            Currently this method is invoked every 5 seconds.
-        """
-        readDatagram = True
-        beginDatagram = False
-        endDatagram = False
-        self.datagramBuffer.clear()
+        while pos < len(data):
+            if not buffer:
+                pos = data.find(SmartMeterConstants.DATAGRAM_INITIATOR, pos)
+                if pos < 0:
+                    break
 
-        while not self.aborted() and readDatagram:
-            c = self.serial.read().decode("utf-8")
+            end = data.find(SmartMeterConstants.DATAGRAM_TERMINATOR, pos)
+            if end < 0:
+                buffer.extend(view[pos:])
+                break
 
-            if c == SmartMeterConstants.DATAGRAM_INITIATOR:
-                beginDatagram = True
-                endDatagram = False
+            buffer.extend(view[pos:end + 1])
+            pos = end + 1
 
-            if c == SmartMeterConstants.DATAGRAM_TERMINATOR and beginDatagram:
-                beginDatagram = False
-                endDatagram = True
+            # If a terminator got lost, the buffer may contain more than one initiator. The last one begins our datagram.
+            with memoryview(buffer)[buffer.rfind(SmartMeterConstants.DATAGRAM_INITIATOR):] as datagram:
+                self.accessLock.acquire()
+                try:
+                    self.extractSmartMeterValues(datagram)
+                finally:
+                    self.accessLock.release()
 
-            if beginDatagram and not endDatagram:
-                self.datagramBuffer.append(c)
+            buffer.clear()
 
-            if endDatagram and not beginDatagram:
-                self.datagramBuffer.append(c)
-                self.extractSmartMeterValues(''.join(self.datagramBuffer))
-                readDatagram = beginDatagram = endDatagram = False
+        # Don't let garbage without any terminator grow the buffer.
+        if len(buffer) > SmartMeterConstants.DATAGRAM_MAX_SIZE:
+            buffer.clear()
 
-        return
+    def connection_lost(self, exc):
+        """ Called by the serial transport when the serial port has been closed.
+        """
+        if exc is not None:
+            logging.error("Lost connection to the D0 interface: {}".format(exc))
 
-class S0InterfaceReader():
+class ReadSmartMeter(threading.Thread):
+    """ This thread runs the event loop reading the D0 interface of the EBZ DD3 until the application shuts down.
+        It isn't a raspend worker thread, since raspend invokes those with the access lock held.
+    """
+    def __init__(self, sectionName, serialPort, sharedDict, accessLock, shutdownFlag, sharedMemory=None):
+        threading.Thread.__init__(self)
+        self.sectionName = sectionName
+        self.serialPort = serialPort
+        self.sharedDict = sharedDict
+        self.accessLock = accessLock
+        self.shutdownFlag = shutdownFlag
+        self.sharedMemory = sharedMemory
+
+    async def readDatagrams(self):
+        """ Opens the connected USB device and lets 'D0Protocol' handle incoming datagrams until shutdown.
+        """
+        loop = asyncio.get_running_loop()
+        transport, protocol = await serial_asyncio_fast.create_serial_connection(loop,
+                                                                                 lambda: D0Protocol(self.sectionName, self.sharedDict, self.accessLock, self.sharedMemory),
+                                                                                 self.serialPort,
+                                                                                 baudrate = 9600,
+                                                                                 parity=serial.PARITY_EVEN,
+                                                                                 stopbits=serial.STOPBITS_ONE,
+                                                                                 bytesize=serial.SEVENBITS)
+        try:
+            # Wait for the shutdown flag in the loop's executor, so we neither poll nor block the loop.
+            await loop.run_in_executor(None, self.shutdownFlag.wait)
+        finally:
+            transport.close()
+
+    def run(self):
+        try:
+            asyncio.run(self.readDatagrams())
+        except Exception as e:
+            logging.exception("Reading the D0 interface failed!", exc_info = True)
+
+class S0InterfaceReader(ThreadHandlerBase):
     """ This class counts the pulses of the Finder smart meter.
-        On every rising edge detected, the GPIO interface invokes the ISR method below.
+        On every rising edge detected, the pigpio daemon invokes the ISR method below.
+        The ISR only stores the time of the pulse in a ring buffer and advances the write index without any locking. 
+        It is the only writer of both, so the write index also counts the pulses and setting a new counter value 
+        just remembers the pulses counted so far as offset. 
+        The ring buffer is drained by this class' worker thread, which publishes the counter value and the time of the 
+        last pulse to the shared dictionary once per second.
     """
-    def __init__(self, sectionName, sharedDict, accessLock):
+    def __init__(self, sectionName, sharedDict, accessLock, sharedMemory=None):
         self.sectionName = sectionName
         self.sharedDict = sharedDict
         if sectionName not in self.sharedDict:
-            self.sharedDict[sectionName] = {"count" : 0.0, "timestampUTC": datetime.now(timezone.utc).isoformat()}
+            self.sharedDict[sectionName] = {"count" : 0.0, "timestampUTC": _isoNowUTC()}
         self.accessLock = accessLock
+        self.sharedMemory = sharedMemory
+        self._base = self.sharedDict[sectionName]["count"]
+        self._ring = array.array("q", [0]) * S0Constants.RING_SIZE
+        self._written = 0
+        self._read = 0
+        self._offset = 0
+
+    def publish(self):
+        """ Drains the ring buffer and writes the current counter value and the time of the last pulse to the shared dictionary. 
+            The caller must hold the access lock.
+        """
+        thisDict = self.sharedDict[self.sectionName]
+        written = self._written
+        if written != self._read:
+            lastPulse = self._ring[(written - 1) & (S0Constants.RING_SIZE - 1)]
+            timestamp = time.time_ns() - (time.monotonic_ns() - lastPulse)
+            # The smart meter outputs 1000 pulses per kWh.
+            thisDict["count"] = self._base + (written - self._offset) * 0.001
+            thisDict["timestampUTC"] = datetime.fromtimestamp(timestamp / 1e9, timezone.utc).isoformat()
+            self._read = written
+            if self.sharedMemory is not None:
+                self.sharedMemory.writeS0(thisDict["count"], timestamp)
+        return thisDict
 
     def setValue(self, value):
         """ This method is used to set the initial counter value of the smart meter. 
+            The value is validated before the access lock is taken, so no I/O happens while holding it.
         """
-        success = False
+        try:
+            base = float(value)
+        except (TypeError, ValueError) as e:
+            logging.error("Invalid S0 counter value '{}': {}".format(value, e))
+            return False
+
         self.accessLock.acquire()
         try:
             thisDict = self.sharedDict[self.sectionName]
-            thisDict["count"] = float(value)
-            thisDict["timestampUTC"] = datetime.now(timezone.utc).isoformat()
-            success = True
-        except Exception as e:
-            print(e)
+            self._base = base
+            self._offset = self._read = self._written
+            thisDict["count"] = base
+            thisDict["timestampUTC"] = _isoNowUTC()
+            if self.sharedMemory is not None:
+                self.sharedMemory.writeS0(base, time.time_ns())
         finally:
             self.accessLock.release()
-        return success
+        return True
 
-    def ISR(self, channel):  
-        """ This is the interrupt service routine invoked by the GPIO interface when a rising edge has been detected.
+    def getSnapshot(self):
+        """ Returns the current counter value and the time of the last pulse.
         """
         self.accessLock.acquire()
         try:
-            thisDict = self.sharedDict[self.sectionName]
-            thisDict["count"] = thisDict["count"] + 0.001
-            thisDict["timestampUTC"] = datetime.now(timezone.utc).isoformat()
-        except Exception as e:
-            print (e)
+            return dict(self.publish())
         finally:
             self.accessLock.release()
 
+    def ISR(self, gpio, level, tick):  
+        """ This is the interrupt service routine invoked by pigpio when a rising edge has been detected.
+        """
+        written = self._written
+        self._ring[written & (S0Constants.RING_SIZE - 1)] = time.monotonic_ns()
+        self._written = written + 1
+
+    def prepare(self):
+        """ Nothing to prepare, since the GPIO pin is set up by the main function.
+        """
+        return
+
+    def invoke(self):
+        """ Drains the ring buffer and publishes the counter value. raspend invokes this method with the access lock held.
+        """
+        self.publish()
+        return
+
 def main():
     localTimeZone = get_localzone()
 
@@ -174,28 +350,46 @@ def main():
     cmdLineParser.add_argument("--port", help="The port number the server should listen on", type=int, required=True)
     cmdLineParser.add_argument("--serialPort", help="The serial port to read from", type=str, required=True)
     cmdLineParser.add_argument("--s0Pin", help="The BCM number of the pin connected to the S0 interface", type=int, required=False)
+    cmdLineParser.add_argument("--sharedMemory", help="The name of a block of shared memory the values should be mirrored to", type=str, required=False)
 
     try: 
         args = cmdLineParser.parse_args()
     except SystemExit:
         return
 
+    pi = None
+    d0Reader = None
+    sharedMemory = None
+
     try:
         myApp = RaspendApplication(args.port)
 
-        myApp.createWorkerThread(ReadSmartMeter("smartmeter_d0", args.serialPort, localTimeZone), 5)
+        if args.sharedMemory is not None:
+            sharedMemory = SharedMemoryMirror(args.sharedMemory)
 
-        s0Interface = S0InterfaceReader("smartmeter_s0", myApp.getSharedDict(), myApp.getAccessLock())
+        s0Interface = S0InterfaceReader("smartmeter_s0", myApp.getSharedDict(), myApp.getAccessLock(), sharedMemory)
 
         if args.s0Pin is not None:
             # Making this method available as a command enables us to set the initial value via HTTP GET.
             # http://<IP-OF-YOUR-RPI>:<PORT>/cmd?name=s0Interface.setValue&value=<COUNT>
             myApp.addCommand(s0Interface.setValue);
+            # http://<IP-OF-YOUR-RPI>:<PORT>/cmd?name=s0Interface.getSnapshot
+            myApp.addCommand(s0Interface.getSnapshot);
+
+            myApp.createWorkerThread(s0Interface, 1)
 
-            # Setup the GPIO pin for detecting rising edges.
-            GPIO.setmode(GPIO.BCM)
-            GPIO.setup(args.s0Pin, GPIO.IN, pull_up_down = GPIO.PUD_DOWN)
-            GPIO.add_event_detect(args.s0Pin, GPIO.RISING, callback = s0Interface.ISR, bouncetime = 200)
+            # Setup the GPIO pin for detecting rising edges. 
+            # Edges are detected and debounced by the pigpio daemon, which reports them to our callback thread.
+            pi = pigpio.pi()
+            if not pi.connected:
+                raise RuntimeError("Unable to connect to the pigpio daemon!")
+            pi.set_mode(args.s0Pin, pigpio.INPUT)
+            pi.set_pull_up_down(args.s0Pin, pigpio.PUD_DOWN)
+            pi.set_glitch_filter(args.s0Pin, S0Constants.GLITCH_FILTER)
+            pi.callback(args.s0Pin, pigpio.RISING_EDGE, s0Interface.ISR)
+
+        d0Reader = ReadSmartMeter("smartmeter_d0", args.serialPort, myApp.getSharedDict(), myApp.getAccessLock(), myApp.getShutdownFlag(), sharedMemory)
+        d0Reader.start()
 
         myApp.run()
 
@@ -204,8 +398,14 @@ def main():
     except Exception as e:
         logging.exception("Unexpected error occured!", exc_info = True)
     finally:
-        if args.s0Pin is not None:
-            GPIO.cleanup()
+        if d0Reader is not None:
+            myApp.getShutdownFlag().set()
+            d0Reader.join()
+        if pi is not None:
+            # Cancels all callbacks and releases the connection to the daemon.
+            pi.stop()
+        if sharedMemory is not None:
+            sharedMemory.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file